@@ -1,19 +1,95 @@
 # libraries for singlepage tiff sequence reading
-import glob
 import json
 import logging
 import os
-
+import shutil
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+import dask
+import dask.array as da
+from dask.base import tokenize
 import natsort
 import numpy as np
 import tifffile as tiff
 import zarr
+from numcodecs import Blosc
 
 from iohub._deprecated.reader_base import ReaderBase
 
+# optional faster JSON parser, install with `pip install iohub[fast-json]`
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# optional streaming JSON parser, install with `pip install iohub[stream-json]`
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_logger = logging.getLogger(__name__)
+
+# top-level metadata keys of image coordinates (mm2-gamma, mm1.4.22)
+# and of per-image metadata (mm2-gamma)
+_COORD_PREFIXES = ("Coords-", "FrameKey-")
+_META_PREFIX = "Metadata-"
+_META_PREFIX_LEN = len(_META_PREFIX)
+
+# the only per-image fields needed to map coordinates to filenames
+_COORD_FIELDS = (
+    "ChannelIndex",
+    "PositionIndex",
+    "FrameIndex",
+    "SliceIndex",
+    "FileName",
+)
+
+
+def _read_plane(fn, out=None):
+    """
+    read the image of a single-page tiff file as a numpy array
+    the first page is decoded directly, which skips
+    the series detection and the zarr store wrapping
+    of tifffile.imread(aszarr=True)
+    without a destination buffer, uncompressed images in native
+    byte order are memory-mapped to avoid a copy
+
+    Parameters
+    ----------
+    fn:             (str) path to a single-page tiff file
+    out:            (np.ndarray, optional)
+        2D buffer to decode the image into
+
+    Returns
+    -------
+    image           (np.ndarray) 2D image plane, `out` if supplied
+
+    """
+    with tiff.TiffFile(fn) as tif:
+        page = tif.pages[0]
+        # a memmap keeps the byte order of the file,
+        # so swapped files are decoded to the native page.dtype
+        native = page.dtype.newbyteorder(tif.byteorder).isnative
+        if out is None and native and page.is_memmappable:
+            return page.asarray(out="memmap")
+        return page.asarray(out=out)
+
 
 class MicromanagerSequenceReader(ReaderBase):
-    def __init__(self, folder, extract_data=False):
+    def __init__(
+        self,
+        folder,
+        extract_data=False,
+        chunk_slices=None,
+        store_path: str | None = None,
+        stream_metadata=False,
+    ):
         super().__init__()
 
         """
@@ -32,6 +108,19 @@ class MicromanagerSequenceReader(ReaderBase):
             which contain singlepage tiff sequences
         extract_data    (bool)
             True if zarr arrays should be extracted immediately
+        chunk_slices    (int)
+            number of z-slices stored together in one zarr chunk,
+            defaults to None, the whole z-stack of a (time, channel)
+        store_path      (str, optional)
+            directory of the zarr store that extracted positions
+            are written to, created on the first extraction
+            defaults to a temporary directory in tempfile.gettempdir()
+            (set TMPDIR to move it off a RAM-backed /tmp),
+            which is removed by close()
+        stream_metadata (bool)
+            stream the metadata.txt of each position with ijson
+            to map image coordinates without holding the parsed file,
+            slower than a full parse but with lower peak memory
         """
 
         if not os.path.isdir(folder):
@@ -39,9 +128,15 @@ class MicromanagerSequenceReader(ReaderBase):
                 "supplied path for singlepage tiff sequence reader "
                 "is not a folder"
             )
+        if stream_metadata and ijson is None:
+            raise ImportError(
+                "streaming metadata requires ijson, "
+                "install it with `pip install iohub[stream-json]`"
+            )
+        self.stream_metadata = stream_metadata
 
-        self.log = logging.getLogger(__name__)
         self.positions = {}
+        self._lazy_positions = {}
         self.num_positions = None
         self.z_step_size = None
         self.height = 0
@@ -51,7 +146,23 @@ class MicromanagerSequenceReader(ReaderBase):
         self.channels = 0
         self.channel_names = []
 
+        if chunk_slices is not None and chunk_slices < 1:
+            raise ValueError(
+                f"chunk_slices must be a positive integer, got {chunk_slices}"
+            )
+        self.chunk_slices = chunk_slices
+        self._compressor = Blosc(
+            cname="zstd", clevel=1, shuffle=Blosc.BITSHUFFLE
+        )
+
+        # extracted positions are written to disk, not held in memory
+        self._store_path = store_path
+        self._store = None
+        self._root = None
+        self._remove_temp_store = None
+
         self.coord_to_filename = {}
+        self._meta_cache: dict[str, dict] = {}
 
         # identify type of subdirectory
         sub_dirs = self._get_sub_dirs(folder)
@@ -67,6 +178,11 @@ class MicromanagerSequenceReader(ReaderBase):
 
         # create coordinate to filename maps
         self.coord_to_filename = self.read_tiff_series(folder)
+        self._index_coordinates()
+
+        # pixel type is not recorded in the summary metadata
+        with tiff.TiffFile(self._filenames[0]) as tif:
+            self.dtype = tif.pages[0].dtype
 
         # update coordinates if the acquisition finished early
         self._dims_from_coordinates()
@@ -76,6 +192,39 @@ class MicromanagerSequenceReader(ReaderBase):
         if extract_data:
             self._create_stores(0)
 
+    def close(self):
+        """
+        remove the temporary zarr store of extracted positions
+        """
+        if self._remove_temp_store is not None:
+            # positions written to a user supplied store_path are kept
+            self._remove_temp_store()
+            self.positions = {}
+            self._store = None
+            self._root = None
+            self._remove_temp_store = None
+
+    def _get_root(self):
+        """
+        zarr group that extracted positions are written to,
+        the store is only created once a position is extracted
+        """
+        if self._root is None:
+            if self._store_path:
+                self._store = zarr.DirectoryStore(self._store_path)
+            else:
+                self._store = zarr.TempStore()
+                # tied to the store object rather than to this reader,
+                # so unpickled copies of the reader do not remove it
+                self._remove_temp_store = weakref.finalize(
+                    self._store,
+                    shutil.rmtree,
+                    self._store.path,
+                    ignore_errors=True,
+                )
+            self._root = zarr.group(store=self._store)
+        return self._root
+
     def _set_mm_meta(self, one_pos):
         """
         assign image metadata from summary metadata
@@ -90,8 +239,7 @@ class MicromanagerSequenceReader(ReaderBase):
         """
         # pull one metadata sample and extract experiment dimensions
         metadata_path = os.path.join(one_pos, "metadata.txt")
-        with open(metadata_path, "r") as f:
-            self._mm_meta = json.load(f)
+        self._mm_meta = self._load_meta(metadata_path)
 
         mm_version = self._mm_meta["Summary"]["MicroManagerVersion"]
         if mm_version == "1.4.22":
@@ -110,6 +258,69 @@ class MicromanagerSequenceReader(ReaderBase):
                     "Metadata parsing failed."
                 )
 
+    def _load_meta(self, path):
+        """
+        load a micro-manager metadata.txt file,
+        parsing each file only once while the coordinates are mapped
+
+        Parameters
+        ----------
+        path:           (str) path to a metadata.txt file
+
+        Returns
+        -------
+        metadata        (dict)
+
+        """
+        path = os.path.abspath(path)
+        j = self._meta_cache.get(path)
+        if j is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            try:
+                j = _loads(data)
+            except ValueError:
+                # orjson is strict about non-standard tokens such as NaN
+                j = json.loads(data)
+            self._meta_cache[path] = j
+        return j
+
+    def _load_coord_meta(self, path):
+        """
+        load only the image coordinate entries of a metadata.txt file
+        with stream_metadata, the file is streamed with ijson so that
+        the full metadata dict is never held in memory
+        otherwise (or if the file is already parsed) fall back to _load_meta
+
+        Parameters
+        ----------
+        path:           (str) path to a metadata.txt file
+
+        Returns
+        -------
+        metadata        (dict)
+            top-level coordinate and image metadata entries,
+            possibly reduced to the fields needed for coordinate mapping
+
+        """
+        if (
+            not self.stream_metadata
+            or os.path.abspath(path) in self._meta_cache
+        ):
+            return self._load_meta(path)
+        json_ = {}
+        try:
+            with open(path, "rb") as f:
+                for key, value in ijson.kvitems(f, ""):
+                    if key.startswith((*_COORD_PREFIXES, _META_PREFIX)):
+                        json_[key] = {
+                            k: value[k] for k in _COORD_FIELDS if k in value
+                        }
+        except ijson.JSONError:
+            # e.g. non-standard tokens, let the full parser handle it
+            return self._load_meta(path)
+        return json_
+
     def get_zarr(self, position):
         """
         return a zarr array for a given position
@@ -127,8 +338,61 @@ class MicromanagerSequenceReader(ReaderBase):
             self._create_stores(position)
         return self.positions[position]
 
+    def get_dask(self, position):
+        """
+        return a lazy dask array for a given position
+        tiff files are only read for the planes that are computed
+
+        Parameters
+        ----------
+        position:       (int) position (aka ome-tiff scene)
+
+        Returns
+        -------
+        position:       (dask.array.Array)
+
+        """
+        if position not in self._lazy_positions.keys():
+            planes = self._pos_slices.get(position, slice(0, 0))
+            if planes.start == planes.stop:
+                raise IOError(f"array at position {position} can not be found")
+            coords = self._unpack_keys(self._keys[planes])[:, 1:].tolist()
+            plane_shape = (self.height, self.width)
+            empty = da.zeros(plane_shape, dtype=self.dtype)
+            read_plane = dask.delayed(_read_plane)
+            # the task keys are tokenized from the file names alone,
+            # hashing the reader itself is slow and not deterministic
+            lazy_planes = {
+                tuple(coord): da.from_delayed(
+                    read_plane(fn, dask_key_name=f"read-plane-{tokenize(fn)}"),
+                    shape=plane_shape,
+                    dtype=self.dtype,
+                )
+                for coord, fn in zip(coords, self._filenames[planes])
+            }
+            stacks = [
+                [
+                    da.stack(
+                        [
+                            lazy_planes.get((t, c, z), empty)
+                            for z in range(self.slices)
+                        ]
+                    )
+                    for c in range(self.channels)
+                ]
+                for t in range(self.frames)
+            ]
+            self._lazy_positions[position] = da.stack(
+                [da.stack(channels) for channels in stacks]
+            )
+        return self._lazy_positions[position]
+
     def get_image(self, p: int, t: int, c: int, z: int):
-        zarray = self.get_zarr(p)
+        # only read the requested plane if the position is not extracted
+        if p in self.positions.keys():
+            zarray = self.positions[p]
+        else:
+            zarray = self.get_dask(p)
         dim_slices = [slice(None)] * 3
         for i, (dim, idx) in enumerate(
             zip((self.frames, self.channels, self.slices), (t, c, z))
@@ -136,7 +400,7 @@ class MicromanagerSequenceReader(ReaderBase):
             if dim > 0:
                 dim_slices[i] = slice(idx, idx + 1)
 
-        image = zarray[tuple(dim_slices)]
+        image = np.asarray(zarray[tuple(dim_slices)])
         return np.squeeze(image)
 
     def get_array(self, position):
@@ -153,11 +417,11 @@ class MicromanagerSequenceReader(ReaderBase):
 
         """
         if position not in self.positions.keys():
-            self.log.info(
+            _logger.info(
                 f"position {position} not yet extracted, extracting ..."
             )
             self._create_stores(position)
-        return np.array(self.positions[position])
+        return self.positions[position][:]
 
     def get_num_positions(self):
         """
@@ -168,12 +432,7 @@ class MicromanagerSequenceReader(ReaderBase):
         number of positions     (int)
 
         """
-        # self.log.warning("num positions for singlepage tiff reader is ambiguous.only loaded positions are reported") # noqa
-        if self.positions:
-            return self.num_positions
-            # return len(self.positions)
-        else:
-            self.log.error("singlepage tiffs not loaded")
+        return self.num_positions
 
     def _create_stores(self, p):
         """
@@ -191,8 +450,14 @@ class MicromanagerSequenceReader(ReaderBase):
 
         """
 
-        self.log.info("")
-        z = zarr.zeros(
+        planes = self._pos_slices.get(p, slice(0, 0))
+        if planes.start == planes.stop:
+            raise IOError(f"array at position {p} can not be found")
+
+        _logger.info("")
+        chunk_slices = self.chunk_slices or self.slices
+        z = self._get_root().zeros(
+            str(p),
             shape=(
                 self.frames,
                 self.channels,
@@ -200,27 +465,53 @@ class MicromanagerSequenceReader(ReaderBase):
                 self.height,
                 self.width,
             ),
-            chunks=(1, 1, 1, self.height, self.width),
-        )
-        for c, fn in self.coord_to_filename.items():
-            if c[0] == p:
-                self.log.info(f"reading coord = {c} from filename = {fn}")
-                with tiff.imread(fn, aszarr=True) as store:
-                    z[c[1], c[2], c[3]] = zarr.open(store)
-
-        # check that the array was assigned
-        if z == zarr.zeros(
-            shape=(
-                self.frames,
-                self.channels,
-                self.slices,
+            chunks=(
+                1,
+                1,
+                min(self.slices, chunk_slices),
                 self.height,
                 self.width,
             ),
-            chunks=(1, 1, 1, self.height, self.width),
-        ):
-            raise IOError(f"array at position {p} can not be found")
-
+            dtype=self.dtype,
+            compressor=self._compressor,
+            overwrite=True,
+        )
+        coords = self._unpack_keys(self._keys[planes])[:, 1:].tolist()
+
+        def _read(c, fn, out):
+            _logger.info(f"reading coord = {(p, *c)} from filename = {fn}")
+            _read_plane(fn, out=out)
+
+        def _write(t, c, stack, futures):
+            for future in futures:
+                future.result()
+            z[t, c] = stack
+
+        # single-page reads are IO-bound and tifffile releases the GIL
+        # while decoding, so overlap them across threads.
+        # files are decoded into a buffer per (time, channel) z-stack,
+        # which is written to zarr in one go once it is complete.
+        # only a few z-stacks are kept in memory at a time
+        workers = os.cpu_count() or 1
+        max_pending = max(2, 2 * workers // self.slices)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (t, c), group in groupby(
+                zip(coords, self._filenames[planes]), key=lambda i: i[0][:2]
+            ):
+                # missing planes of an interrupted acquisition stay zero
+                stack = np.zeros(z.shape[2:], dtype=self.dtype)
+                futures = [
+                    executor.submit(_read, coord, fn, stack[coord[2]])
+                    for coord, fn in group
+                ]
+                pending.append((t, c, stack, futures))
+                if len(pending) > max_pending:
+                    _write(*pending.popleft())
+            while pending:
+                _write(*pending.popleft())
+
+        zarr.consolidate_metadata(self._store)
         self.positions[p] = z
 
     def read_tiff_series(self, folder: str):
@@ -241,11 +532,7 @@ class MicromanagerSequenceReader(ReaderBase):
             Coordinates follow (p, t, c, z) indexing.
         """
 
-        positions = [
-            p
-            for p in os.listdir(folder)
-            if os.path.isdir(os.path.join(folder, p))
-        ]
+        positions = self._get_sub_dirs(folder)
         if not positions:
             raise FileNotFoundError(
                 "no position subfolder found in supplied folder"
@@ -260,14 +547,37 @@ class MicromanagerSequenceReader(ReaderBase):
                 "no metadata.txt file found in position directories"
             )
 
+        # overlap reading the metadata files of a few positions,
+        # merging each one in position order as soon as it is parsed.
+        # parsing holds the GIL, so only file IO runs concurrently
+        # and at most `workers` parsed files are held at a time
+        workers = min(4, len(metadatas))
         coord_filename_map = {}
-        for idx, metadata in enumerate(metadatas):
-            with open(metadata, "r") as m:
-                j = json.load(m)
-                coord_filename_map.update(
-                    self._extract_coord_to_filename(j, folder, positions[idx])
+        pending = deque()
+
+        def _merge():
+            future, position = pending.popleft()
+            coord_filename_map.update(
+                self._extract_coord_to_filename(
+                    future.result(), folder, position
+                )
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for metadata, position in zip(metadatas, positions):
+                pending.append(
+                    (
+                        executor.submit(self._load_coord_meta, metadata),
+                        position,
+                    )
                 )
+                if len(pending) >= workers:
+                    _merge()
+            while pending:
+                _merge()
         self.num_positions = len(positions)
+        # only the summary metadata (self._mm_meta) is kept around
+        self._meta_cache.clear()
 
         return coord_filename_map
 
@@ -302,15 +612,12 @@ class MicromanagerSequenceReader(ReaderBase):
 
         # separate coords from meta
         for element in json_.keys():
-            # present for mm2-gamma metadata
-            if "Coords" in element:
-                coords.add(element)
-            if "Metadata" in element:
-                meta["-".join(element.split("-")[1:])] = element
-
-            # present in mm1.4.22 metadata
-            if "FrameKey" in element:
+            # 'Coords' present for mm2-gamma metadata,
+            # 'FrameKey' present in mm1.4.22 metadata
+            if element.startswith(_COORD_PREFIXES):
                 coords.add(element)
+            elif element.startswith(_META_PREFIX):
+                meta[element[_META_PREFIX_LEN:]] = element
 
         if not coords:
             raise ValueError("no image coordinates present in metadata")
@@ -318,27 +625,27 @@ class MicromanagerSequenceReader(ReaderBase):
         # build a dict of coord to filename maps
         coord_to_filename = dict()
         for c in coords:
+            coord_meta = json_[c]
             # indices common to both mm2 and mm1
-            ch_idx = json_[c]["ChannelIndex"]
-            pos_idx = json_[c]["PositionIndex"]
-            time_idx = json_[c]["FrameIndex"]
-            z_idx = json_[c]["SliceIndex"]
+            ch_idx = coord_meta["ChannelIndex"]
+            pos_idx = coord_meta["PositionIndex"]
+            time_idx = coord_meta["FrameIndex"]
+            z_idx = coord_meta["SliceIndex"]
 
             # extract filepath for this coordinate
+            meta_key = meta.get(c.partition("-")[2])
             try:
                 # for mm2-gamma. 'FileName' key contains position folder
-                if "-".join(c.split("-")[1:]) in meta:
-                    filepath = json_[meta["-".join(c.split("-")[1:])]][
-                        "FileName"
-                    ]
+                if meta_key is not None:
+                    filepath = json_[meta_key]["FileName"]
                 # for mm1, 'FileName' key does not contain position folder
                 else:
-                    filepath = json_[c]["FileName"]
+                    filepath = coord_meta["FileName"]
                     filepath = os.path.join(
                         position, filepath
                     )  # position name is explicitly supplied
             except KeyError as ke:
-                self.log.error(
+                _logger.error(
                     f"metadata for supplied image coordinate {c} not found"
                 )
                 raise ke
@@ -364,34 +671,102 @@ class MicromanagerSequenceReader(ReaderBase):
         sub_dir_name    (list) natsorted list of subdirectories
         """
 
-        sub_dir_path = glob.glob(os.path.join(f, "*/"))
-        sub_dir_name = [
-            os.path.split(subdir[:-1])[1] for subdir in sub_dir_path
-        ]
+        # DirEntry caches the file type, saving a stat call per entry
+        with os.scandir(f) as it:
+            sub_dir_name = [
+                e.name for e in it if e.is_dir() and not e.name.startswith(".")
+            ]
         #    assert subDirName, 'No sub directories found'
         return natsort.natsorted(sub_dir_name)
 
+    def _index_coordinates(self):
+        """
+        store self.coord_to_filename as parallel arrays
+        of packed uint64 coordinate keys (N,) and filenames (N,),
+        sorted by (p, t, c, z)
+        so that the images of each position form one contiguous slice
+        each index gets as many bits of the key as its largest value needs
+
+        Returns
+        -------
+
+        """
+        coords = np.array(
+            list(self.coord_to_filename.keys()), dtype=np.int64
+        ).reshape(-1, 4)
+        if coords.min() < 0:
+            raise ValueError(
+                f"image coordinates must be non-negative, got {coords.min()}"
+            )
+        bits = [max(1, int(m).bit_length()) for m in coords.max(axis=0)]
+        if sum(bits) > 64:
+            raise ValueError(
+                "image coordinates do not fit in a 64-bit key, "
+                f"largest (p, t, c, z) = {tuple(coords.max(axis=0))}"
+            )
+        # the position takes the most significant bits
+        self._key_shifts = np.array(
+            np.cumsum([0] + bits[:0:-1])[::-1], dtype=np.uint64
+        )
+        self._key_masks = (
+            np.uint64(1) << np.array(bits, dtype=np.uint64)
+        ) - np.uint64(1)
+        keys = np.bitwise_or.reduce(
+            coords.astype(np.uint64) << self._key_shifts, axis=1
+        )
+        filenames = np.array(
+            list(self.coord_to_filename.values()), dtype=object
+        )
+        order = np.argsort(keys)
+        self._keys = keys[order]
+        self._filenames = filenames[order]
+
+        positions, starts = np.unique(
+            self._keys >> self._key_shifts[0], return_index=True
+        )
+        stops = np.append(starts[1:], len(self._keys))
+        self._pos_slices = {
+            p: slice(start, stop)
+            for p, start, stop in zip(
+                positions.tolist(), starts.tolist(), stops.tolist()
+            )
+        }
+
+    def _unpack_keys(self, keys):
+        """
+        unpack coordinate keys built by _index_coordinates
+
+        Parameters
+        ----------
+        keys:           (np.ndarray) (N,) packed uint64 keys
+
+        Returns
+        -------
+        coords          (np.ndarray) (N, 4) coordinates (p, t, c, z)
+
+        """
+        return (
+            (keys[:, np.newaxis] >> self._key_shifts) & self._key_masks
+        ).astype(np.int64)
+
     def _dims_from_coordinates(self):
         """
-        read coordinates from self.coord_to_filename
-        parse the coordinates for the total number unique elements
+        read coordinates from self._keys
+        parse the coordinates for the largest index
         in each tuple position
-        this total number reflects the true dimensionality
+        this index + 1 reflects the true dimensionality
         coord = (pos, time, chan, z)
         height and width are still read from mm metadata
         Returns
         -------
 
         """
-        p, t, c, z = set(), set(), set(), set()
-        for coord in self.coord_to_filename.keys():
-            p.add(coord[0])
-            t.add(coord[1])
-            c.add(coord[2])
-            z.add(coord[3])
-        self.frames = len(t)
-        self.slices = len(z)
-        self.channels = len(c)
+        coords = self._unpack_keys(self._keys)
+        # indices are 0-based array offsets,
+        # planes skipped within that range are left empty
+        self.frames, self.channels, self.slices = (
+            coords[:, 1:].max(axis=0) + 1
+        ).tolist()
 
     def _mm1_meta_parser(self):
         """
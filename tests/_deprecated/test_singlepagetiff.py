@@ -1,6 +1,15 @@
+import gc
+import json
+import math
+import os
+
+import dask.array as da
 import numpy as np
+import pytest
+import tifffile
 import zarr
 
+from iohub._deprecated import singlepagetiff
 from iohub._deprecated.singlepagetiff import MicromanagerSequenceReader
 from tests.conftest import (
     mm2gamma_singlepage_tiffs,
@@ -9,6 +18,57 @@ from tests.conftest import (
 )
 
 
+def _write_mm2gamma_dataset(
+    root,
+    positions=1,
+    frames=(0, 1),
+    channels=2,
+    slices=3,
+    shape=(8, 16),
+    nan=False,
+    byteorder="<",
+):
+    """Write a small mm2-gamma single-page tiff dataset."""
+    rng = np.random.default_rng(42)
+    for p in range(positions):
+        pos = f"Pos{p}"
+        (root / pos).mkdir(parents=True)
+        metadata = {
+            "Summary": {
+                "MicroManagerVersion": "2.0.0-gamma1",
+                "z-step_um": 0.5,
+                "Frames": len(frames),
+                "Slices": slices,
+                "Channels": channels,
+            }
+        }
+        for t in frames:
+            for c in range(channels):
+                for z in range(slices):
+                    name = f"{pos}/img_channel{c:03d}_position{p:03d}"
+                    name += f"_time{t:09d}_z{z:03d}.tif"
+                    metadata[f"Coords-{name}"] = {
+                        "ChannelIndex": c,
+                        "PositionIndex": p,
+                        "FrameIndex": t,
+                        "SliceIndex": z,
+                    }
+                    metadata[f"Metadata-{name}"] = {
+                        "Width": shape[1],
+                        "Height": shape[0],
+                        "FileName": name,
+                        "Exposure-ms": math.nan if nan else 10.0,
+                    }
+                    tifffile.imwrite(
+                        root / name,
+                        rng.integers(0, 4096, shape, dtype=np.uint16),
+                        byteorder=byteorder,
+                    )
+        with open(root / pos / "metadata.txt", "w") as f:
+            json.dump(metadata, f)
+    return root
+
+
 def pytest_generate_tests(metafunc):
     if "single_page_tiff" in metafunc.fixturenames:
         metafunc.parametrize(
@@ -74,6 +134,170 @@ def test_get_array(single_page_tiff):
         assert isinstance(z, np.ndarray)
 
 
+def test_get_dask(single_page_tiff):
+    mmr = MicromanagerSequenceReader(single_page_tiff, extract_data=True)
+    for i in range(mmr.get_num_positions()):
+        d = mmr.get_dask(i)
+        assert d.shape == mmr.shape
+        assert isinstance(d, da.Array)
+        assert np.array_equal(d.compute(), mmr.get_array(i))
+
+
 def test_get_num_positions(single_page_tiff):
     mmr = MicromanagerSequenceReader(single_page_tiff, extract_data=True)
     assert mmr.get_num_positions() >= 1
+
+
+def test_get_num_positions_not_extracted(single_page_tiff):
+    mmr = MicromanagerSequenceReader(single_page_tiff, extract_data=False)
+    assert mmr.get_num_positions() >= 1
+
+
+def test_get_zarr_store_path(tmp_path):
+    store_path = tmp_path / "positions.zarr"
+    mmr = MicromanagerSequenceReader(
+        mm2gamma_singlepage_tiffs[0], store_path=str(store_path)
+    )
+    z = mmr.get_zarr(0)
+    assert z.shape == mmr.shape
+    stored = zarr.open_consolidated(str(store_path), mode="r")
+    assert np.array_equal(stored["0"][:], mmr.get_array(0))
+
+
+def test_temp_store_cleanup(tmp_path):
+    data = _write_mm2gamma_dataset(tmp_path / "data")
+    mmr = MicromanagerSequenceReader(data)
+    # reading metadata does not create a store
+    assert mmr._store is None
+    mmr.get_zarr(0)
+    store_dir = mmr._store.path
+    assert os.path.isdir(store_dir)
+    mmr.close()
+    assert not os.path.exists(store_dir)
+    # positions can be extracted again after closing
+    z = mmr.get_zarr(0)
+    store_dir = mmr._store.path
+    # the temporary store lives as long as arrays refer to it
+    del mmr
+    gc.collect()
+    assert os.path.isdir(store_dir)
+    assert z[:].any()
+    del z
+    gc.collect()
+    assert not os.path.exists(store_dir)
+
+
+def test_coord_to_filename_ijson(tmp_path, monkeypatch):
+    pytest.importorskip("ijson")
+    data = _write_mm2gamma_dataset(tmp_path / "data", positions=2)
+    mmr = MicromanagerSequenceReader(data, stream_metadata=True)
+    streamed = mmr.coord_to_filename
+    # only coordinate entries are kept when streaming
+    coord_meta = mmr._load_coord_meta(str(data / "Pos1" / "metadata.txt"))
+    assert "Summary" not in coord_meta
+    monkeypatch.setattr(singlepagetiff, "ijson", None)
+    parsed = MicromanagerSequenceReader(data).coord_to_filename
+    assert len(parsed) == 2 * 2 * 2 * 3
+    assert streamed == parsed
+    with pytest.raises(ImportError):
+        MicromanagerSequenceReader(data, stream_metadata=True)
+
+
+def test_load_meta_nan(tmp_path):
+    data = _write_mm2gamma_dataset(tmp_path / "data", nan=True)
+    mmr = MicromanagerSequenceReader(data)
+    metadata_path = str(data / "Pos0" / "metadata.txt")
+    # orjson rejects NaN, which falls back to the standard library
+    metadata = mmr._load_meta(metadata_path)
+    image_meta = [v for k, v in metadata.items() if k.startswith("Metadata")]
+    assert math.isnan(image_meta[0]["Exposure-ms"])
+
+
+def test_load_coord_meta_nan(tmp_path):
+    pytest.importorskip("ijson")
+    data = _write_mm2gamma_dataset(tmp_path / "data", nan=True)
+    mmr = MicromanagerSequenceReader(data, stream_metadata=True)
+    metadata_path = str(data / "Pos0" / "metadata.txt")
+    # the ijson stream falls back to the full parse on NaN
+    assert mmr._load_coord_meta(metadata_path) == mmr._load_meta(metadata_path)
+
+
+@pytest.mark.parametrize("chunk_slices", [None, 1, 2, 5])
+def test_chunk_slices(tmp_path, chunk_slices):
+    data = _write_mm2gamma_dataset(tmp_path / "data", slices=3)
+    mmr = MicromanagerSequenceReader(data, chunk_slices=chunk_slices)
+    z = mmr.get_zarr(0)
+    assert z.chunks[2] == min(chunk_slices or mmr.slices, mmr.slices)
+    assert np.array_equal(z[:], mmr.get_dask(0).compute())
+    for (_, t, c, s), fn in mmr.coord_to_filename.items():
+        assert np.array_equal(z[t, c, s], tifffile.imread(fn))
+
+
+@pytest.mark.parametrize("chunk_slices", [0, -1])
+def test_chunk_slices_invalid(tmp_path, chunk_slices):
+    data = _write_mm2gamma_dataset(tmp_path / "data")
+    with pytest.raises(ValueError):
+        MicromanagerSequenceReader(data, chunk_slices=chunk_slices)
+
+
+def test_output_dims_skipped_frames(tmp_path):
+    data = _write_mm2gamma_dataset(tmp_path / "data", frames=(0, 2))
+    mmr = MicromanagerSequenceReader(data)
+    assert mmr.frames == 3
+    z = mmr.get_zarr(0)
+    assert z.shape == mmr.shape
+    assert not z[1].any()
+    assert z[2].any()
+
+
+def test_get_dask_deterministic(tmp_path):
+    data = _write_mm2gamma_dataset(tmp_path / "data")
+    first = MicromanagerSequenceReader(data).get_dask(0)
+    second = MicromanagerSequenceReader(data).get_dask(0)
+    assert first.name == second.name
+
+
+def test_big_endian_dtype(tmp_path):
+    # skipped frame 1 mixes zero planes with the decoded ones
+    data = _write_mm2gamma_dataset(
+        tmp_path / "data", frames=(0, 2), byteorder=">"
+    )
+    mmr = MicromanagerSequenceReader(data)
+    assert mmr.dtype == np.uint16
+    lazy = mmr.get_dask(0).compute()
+    assert lazy.dtype == mmr.dtype
+    image = mmr.get_image(0, 1, 0, 2)
+    assert image.dtype == mmr.dtype
+    plane = singlepagetiff._read_plane(mmr.coord_to_filename[(0, 0, 0, 0)])
+    assert plane.dtype.isnative
+    mmr._create_stores(0)
+    extracted = mmr.get_image(0, 1, 0, 2)
+    assert extracted.dtype == mmr.dtype
+    np.testing.assert_array_equal(extracted, image)
+
+
+def test_large_frame_index(tmp_path):
+    data = _write_mm2gamma_dataset(
+        tmp_path / "data", positions=2, frames=(0, 70000), slices=1
+    )
+    mmr = MicromanagerSequenceReader(data)
+    assert mmr.frames == 70001
+    assert mmr.get_num_positions() == 2
+    # coordinates survive packing and sorting
+    unpacked = mmr._unpack_keys(mmr._keys).tolist()
+    assert unpacked == sorted(map(list, mmr.coord_to_filename))
+    z = mmr.get_zarr(1)
+    fn = mmr.coord_to_filename[(1, 70000, 1, 0)]
+    assert np.array_equal(z[70000, 1, 0], tifffile.imread(fn))
+
+
+def test_rewritten_tiff_file(tmp_path):
+    data = _write_mm2gamma_dataset(tmp_path / "data")
+    mmr = MicromanagerSequenceReader(data)
+    fn = mmr.coord_to_filename[(0, 1, 1, 2)]
+    assert np.array_equal(mmr.get_image(0, 1, 1, 2), tifffile.imread(fn))
+    # a different size on disk and a new modification time
+    image = np.full((8, 16), 7, dtype=np.uint16)
+    tifffile.imwrite(fn, image, compression="zlib")
+    assert np.array_equal(mmr.get_image(0, 1, 1, 2), image)
+    mmr.close()